@@ -16,11 +16,9 @@
 
 import os
 import logging
-import time
 import urllib
 import urlparse
 
-from gi.repository import GConf
 from gi.repository import Gtk
 from gi.repository import WebKit
 
@@ -30,7 +28,6 @@ from cpsection.webaccount.web_service import WebService
 
 
 class WebService(WebService):
-    FB_APP_ID = "172917389475707"
     FB_REDIRECT_URI = "http://www.sugarlabs.org"
 
     def __init__(self):
@@ -61,7 +58,7 @@ class WebService(WebService):
 
     def _fb_auth_url(self):
         url = 'http://www.facebook.com/dialog/oauth'
-        params = [('client_id', self.FB_APP_ID),
+        params = [('client_id', self._account.FB_APP_ID),
                   ('redirect_uri', self.FB_REDIRECT_URI),
                   ('response_type', 'token'),
                   ('scope', 'publish_stream')]
@@ -81,17 +78,8 @@ class WebService(WebService):
 
     def _fb_save_access_token(self, access_token, expires_in):
         logging.debug('FB SAVE ACCESS TOKEN')
-        client = GConf.Client.get_default()
-
-        # client.set_string(self._account.Account.ACCESS_TOKEN_KEY,
-        client.set_string(self._account.ACCESS_TOKEN_KEY,
-                          access_token)
-
-        expiry_time = int(time.time()) + expires_in
-        client.set_int(
-            # self._account.Account.ACCESS_TOKEN_KEY_EXPIRATION_DATE,
-            self._account.ACCESS_TOKEN_KEY_EXPIRATION_DATE,
-            expiry_time)
+        # the account exchanges it for a long-lived token when it can
+        self._account.set_access_token(access_token, expires_in)
 
 
 def get_service():
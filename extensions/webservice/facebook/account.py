@@ -24,7 +24,7 @@ from gettext import gettext as _
 import logging
 import os
 import tempfile
-# import time
+import time
 import json
 
 from gi.repository import Gtk
@@ -50,22 +50,71 @@ COMMENT_IDS = 'fb_comment_ids'
 
 class Account(account.Account):
 
+    FB_APP_ID = "172917389475707"
+
     ACCESS_TOKEN_KEY = "/desktop/sugar/collaboration/facebook_access_token"
     ACCESS_TOKEN_KEY_EXPIRATION_DATE = \
         "/desktop/sugar/collaboration/facebook_access_token_expiration_date"
+    APP_SECRET_KEY = "/desktop/sugar/collaboration/facebook_app_secret"
+    TOKEN_EXCHANGE_URL_KEY = \
+        "/desktop/sugar/collaboration/facebook_token_exchange_url"
+    # in bytes per second, shared by all the transfers, 0 for no limit
+    MAX_UPLOAD_SPEED_KEY = \
+        "/desktop/sugar/collaboration/facebook_max_upload_speed"
+    MAX_DOWNLOAD_SPEED_KEY = \
+        "/desktop/sugar/collaboration/facebook_max_download_speed"
 
     def __init__(self):
         self.facebook = accountsmanager.get_service('facebook')
         self._client = GConf.Client.get_default()
         self.facebook.FbAccount.set_access_token(self._access_token())
+        self._setup_token_manager()
+        self.facebook.FbPhoto.client().set_speed_limits(
+            self._client.get_int(self.MAX_UPLOAD_SPEED_KEY),
+            self._client.get_int(self.MAX_DOWNLOAD_SPEED_KEY))
         self._shared_journal_entry = None
 
+    def _setup_token_manager(self):
+        token_manager = self.facebook.FbAccount.session().token_manager
+        token_manager.configure(
+            self.FB_APP_ID,
+            self._client.get_string(self.APP_SECRET_KEY),
+            self._client.get_string(self.TOKEN_EXCHANGE_URL_KEY))
+        token_manager.set_expiration_date(
+            self._client.get_int(self.ACCESS_TOKEN_KEY_EXPIRATION_DATE))
+        token_manager.exchanged_cb = self._access_token_exchanged_cb
+
+    def set_access_token(self, access_token, expires_in):
+        """ store a new token, and exchange it for a long-lived one when
+        possible """
+        self._save_access_token(access_token, int(time.time()) + expires_in)
+
+        self.facebook.FbAccount.set_access_token(access_token)
+        token_manager = self.facebook.FbAccount.session().token_manager
+        token_manager.set_expiration_date(int(time.time()) + expires_in)
+        if token_manager.can_exchange():
+            token_manager.exchange(self.facebook.FbPhoto.client())
+            self.facebook.FbPhoto.pump()
+
+    def _access_token_exchanged_cb(self, token_manager):
+        logging.debug('_access_token_exchanged_cb')
+        expiration_date = token_manager.expiration_date
+        if expiration_date == 0:
+            # no expiry came with the token, keep the one we know of
+            expiration_date = \
+                self._client.get_int(self.ACCESS_TOKEN_KEY_EXPIRATION_DATE)
+        self._save_access_token(token_manager.session.access_token(),
+                                expiration_date)
+
+    def _save_access_token(self, access_token, expiration_date):
+        self._client.set_string(self.ACCESS_TOKEN_KEY, access_token)
+        self._client.set_int(self.ACCESS_TOKEN_KEY_EXPIRATION_DATE,
+                             expiration_date)
+
     def get_description(self):
         return ACCOUNT_NAME
 
     def get_token_state(self):
-        import time
-
         now = time.time()
 
         if self._access_token() is None:
@@ -140,6 +189,11 @@ class _ShareMenu(MenuItem):
                                    ([str])),
     }
 
+    # Send the title and description as the photo caption, in the same
+    # request as the upload. When False, they are posted as a separate
+    # comment once the photo has been created.
+    CAPTION_IN_UPLOAD = True
+
     def __init__(self, account, get_uid_list, is_active):
         MenuItem.__init__(self, ACCOUNT_NAME)
 
@@ -170,7 +224,12 @@ class _ShareMenu(MenuItem):
                           self._photo_create_failed_cb,
                           tmp_file)
 
-            GObject.idle_add(photo.create, tmp_file)
+            if self.CAPTION_IN_UPLOAD:
+                caption = self._caption_from_metadata(self._get_metadata())
+            else:
+                caption = None
+            GObject.idle_add(photo.create, tmp_file, caption,
+                             self._facebook.FB_PRIORITY_BULK)
         else:
             logging.error(
                 "_facebook_share_menu_cb failed to get photo from datastore")
@@ -183,15 +242,12 @@ class _ShareMenu(MenuItem):
 
         metadata = self._get_metadata()
 
-        comment = ''
-        if 'title' in metadata:
-            comment += '%s:' % str(metadata['title'])
-        if 'description' in metadata:
-            comment += str(metadata['description'])
-
-        fb_photo.connect('comment-added', self._comment_added_cb)
-        fb_photo.connect('comment-add-failed', self._comment_add_failed_cb)
-        fb_photo.add_comment(comment)
+        if not self.CAPTION_IN_UPLOAD:
+            fb_photo.connect('comment-added', self._comment_added_cb)
+            fb_photo.connect('comment-add-failed',
+                             self._comment_add_failed_cb)
+            fb_photo.add_comment(self._caption_from_metadata(metadata),
+                                 self._facebook.FB_PRIORITY_BULK)
 
         try:
             ds_object = datastore.get(metadata['uid'])
@@ -201,6 +257,20 @@ class _ShareMenu(MenuItem):
             logging.debug("_photo_created_cb failed to write to datastore: " %
                           str(ex))
 
+    def _caption_from_metadata(self, metadata):
+        caption = ''
+        if 'title' in metadata:
+            caption += '%s:' % self._utf8(metadata['title'])
+        if 'description' in metadata:
+            caption += self._utf8(metadata['description'])
+        return caption
+
+    def _utf8(self, text):
+        # str() fails on the non-ASCII unicode and dbus.String values
+        if isinstance(text, unicode):
+            return text.encode('utf-8')
+        return str(text)
+
     def _photo_create_failed_cb(self, fb_photo, failed_reason, tmp_file):
         logging.debug("_photo_create_failed_cb")
 
@@ -298,7 +368,8 @@ fb_object_id in metadata')
                          self._fb_comments_downloaded_cb)
         fb_photo.connect('comments-download-failed',
                          self._fb_comments_download_failed_cb)
-        GObject.idle_add(fb_photo.refresh_comments)
+        GObject.idle_add(fb_photo.refresh_comments,
+                         self._facebook.FB_PRIORITY_INTERACTIVE)
 
     def _fb_comments_downloaded_cb(self, fb_photo, comments):
         logging.debug('_fb_comments_downloaded_cb')
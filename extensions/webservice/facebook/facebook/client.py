@@ -0,0 +1,1010 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Raul Gutierrez S. - rgs@itevenworks.net
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+
+import argparse
+import json
+import logging
+import os
+import pycurl
+import time
+import urllib
+import urlparse
+
+
+class FbAccount():
+    """ The default session, used when none is given """
+    _session = None
+
+    @classmethod
+    def session(cls):
+        if cls._session is None:
+            cls._session = FbSession()
+        return cls._session
+
+    @classmethod
+    def set_access_token(cls, access_token):
+        cls.session().set_access_token(access_token)
+
+    @classmethod
+    def access_token(cls):
+        return cls.session().access_token()
+
+
+class FbSession(object):
+    """ Everything that is per account: the access token, the connection
+    cache and the rate-limit budget.
+
+    Requests take the access token when they are submitted, so changing
+    it does not affect the requests already queued or in flight.
+    """
+
+    def __init__(self, access_token=""):
+        self._access_token = access_token
+        self._share = None
+        self.budget = _FbBudget()
+        self.token_manager = FbTokenManager(self)
+
+    def set_access_token(self, access_token):
+        self._access_token = access_token
+
+    def access_token(self):
+        return self._access_token
+
+    def share(self):
+        """ the curl share handle holding the connection cache """
+        if self._share is None:
+            self._share = pycurl.CurlShare()
+            for lock in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION',
+                         'LOCK_DATA_CONNECT'):
+                if hasattr(pycurl, lock):
+                    try:
+                        self._share.setopt(pycurl.SH_SHARE,
+                                           getattr(pycurl, lock))
+                    except pycurl.error as ex:
+                        logging.debug("FbSession can't share %s: %s" %
+                                      (lock, str(ex)))
+        return self._share
+
+
+class FbTransport():
+    """ Connection settings shared by all the Graph API transfers.
+
+    In compressed mode responses are requested gzip/deflate encoded and
+    HTTP/2 is preferred when libcurl was built with it, so that requests
+    multiplex over a single connection kept in the connection cache of
+    their session. Older libcurl versions fall back to plain HTTP/1.1.
+    """
+    _compressed = True
+
+    @classmethod
+    def set_compressed(cls, compressed):
+        cls._compressed = compressed
+
+    @classmethod
+    def compressed(cls):
+        return cls._compressed
+
+    @classmethod
+    def http2_supported(cls):
+        features = pycurl.version_info()[4]
+        return hasattr(pycurl, 'VERSION_HTTP2') and \
+            bool(features & pycurl.VERSION_HTTP2)
+
+    @classmethod
+    def setup_multi(cls, m):
+        if cls._compressed and cls.http2_supported() and \
+                hasattr(pycurl, 'PIPE_MULTIPLEX'):
+            m.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+
+    @classmethod
+    def setup(cls, c, session):
+        c.setopt(c.SHARE, session.share())
+        if not cls._compressed:
+            return
+
+        # an empty string asks for every encoding libcurl can decode
+        c.setopt(c.ENCODING, "")
+
+        if cls.http2_supported():
+            if hasattr(pycurl, 'CURL_HTTP_VERSION_2TLS'):
+                version = pycurl.CURL_HTTP_VERSION_2TLS
+            else:
+                version = pycurl.CURL_HTTP_VERSION_2_0
+            c.setopt(c.HTTP_VERSION, version)
+            if hasattr(c, 'PIPEWAIT'):
+                c.setopt(c.PIPEWAIT, 1)
+
+
+class FbTokenManager(object):
+    """ Keeps the access token of a session usable.
+
+    Tokens are exchanged for long-lived ones at exchange_url, which can
+    point to a local stand-in that holds the app secret, and exchanged
+    again once they get within REFRESH_MARGIN seconds of their expiry.
+    Before large uploads the token is checked with a cheap request, at
+    most every CHECK_INTERVAL seconds, so a stale token fails the upload
+    before the image is sent instead of after.
+    """
+    EXCHANGE_URL = "https://graph.facebook.com/oauth/access_token"
+    CHECK_URL = "https://graph.facebook.com/me"
+    REFRESH_MARGIN = 24 * 3600
+    CHECK_INTERVAL = 600
+    TIMEOUT = 30
+    AUTH_ERROR_CODES = (102, 190)
+
+    def __init__(self, session, app_id=None, app_secret=None,
+                 exchange_url=None):
+        self.session = session
+        self.expiration_date = 0
+        # called with the manager once a new token has been obtained
+        self.exchanged_cb = None
+        self._checked = 0
+        self._exchange_failed = 0
+        self.configure(app_id, app_secret, exchange_url)
+
+    def configure(self, app_id, app_secret=None, exchange_url=None):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.exchange_url = exchange_url or self.EXCHANGE_URL
+
+    def can_exchange(self):
+        """ the Graph API needs the app secret, a stand-in may not """
+        return bool(self.app_id) and \
+            (bool(self.app_secret) or self.exchange_url != self.EXCHANGE_URL)
+
+    def set_expiration_date(self, expiration_date):
+        self.expiration_date = expiration_date
+
+    def needs_refresh(self, now):
+        return self.can_exchange() and self.expiration_date != 0 and \
+            self.expiration_date - now < self.REFRESH_MARGIN and \
+            now - self._exchange_failed > self.CHECK_INTERVAL
+
+    def needs_check(self, now):
+        return now - self._checked > self.CHECK_INTERVAL
+
+    def exchange(self, client, callback=None):
+        """ exchange the session token for a long-lived one """
+        params = [('grant_type', 'fb_exchange_token'),
+                  ('client_id', self.app_id),
+                  ('fb_exchange_token', self.session.access_token())]
+        if self.app_secret:
+            params.append(('client_secret', self.app_secret))
+
+        def exchanged_cb(request):
+            if request.error is None:
+                now = time.time()
+                access_token, expires_in = request.value
+                self.session.set_access_token(access_token)
+                if expires_in:
+                    self.expiration_date = int(now) + expires_in
+                else:
+                    # unknown, so never refreshed ahead of time
+                    self.expiration_date = 0
+                if self.expiration_date != 0 and \
+                        self.expiration_date - now < self.REFRESH_MARGIN:
+                    # exchanging it again now would not get any further
+                    self._exchange_failed = now
+                self._checked = now
+                if self.exchanged_cb is not None:
+                    self.exchanged_cb(self)
+            else:
+                logging.debug("FbTokenManager: exchange failed: %s" %
+                              (request.error))
+                self._exchange_failed = time.time()
+
+            if callback is not None:
+                callback(request)
+
+        # a POST, so the app secret is not part of the logged URL
+        return client._submit(self.session, FB_TOKEN, self.exchange_url,
+                              params, True, self.TIMEOUT,
+                              _token_from_response, exchanged_cb,
+                              FB_PRIORITY_INTERACTIVE)
+
+    def check(self, client, callback=None):
+        """ make a cheap request to find out if the token still works """
+        def checked_cb(request):
+            if request.error is None:
+                self._checked = time.time()
+            if callback is not None:
+                callback(request)
+
+        return client._submit(self.session, FB_TOKEN, self.CHECK_URL,
+                              [('fields', 'id')], False, self.TIMEOUT,
+                              _id_from_response, checked_cb,
+                              FB_PRIORITY_INTERACTIVE)
+
+    @classmethod
+    def is_auth_error(cls, response_str):
+        """ whether the Graph API turned the access token down """
+        try:
+            error = json.loads(response_str)['error']
+            code = error.get('code')
+            if code in FbScheduler.THROTTLE_ERROR_CODES:
+                # these are reported as OAuthException too
+                return False
+            return code in cls.AUTH_ERROR_CODES or \
+                error.get('type') == 'OAuthException'
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+
+    def preflight(self, client, callback):
+        """ submit what is due before a large upload, returning the
+        request callback will be called with, or None if nothing is """
+        now = time.time()
+        if self.needs_refresh(now):
+            def exchanged_cb(request):
+                if request.error is None:
+                    callback(request)
+                else:
+                    # the old token may well be still usable
+                    self.check(client, callback)
+
+            return self.exchange(client, exchanged_cb)
+        elif self.needs_check(now):
+            return self.check(client, callback)
+
+        return None
+
+
+class _FbBudget():
+    """ Token bucket for the requests made on behalf of one account.
+
+    The refill rate drops as the usage reported by the Graph API gets
+    close to 100%, and no tokens are handed out while the account is
+    backing off from a throttling error.
+    """
+    CAPACITY = 10.0
+    REFILL_RATE = 0.5  # requests per second
+    MIN_REFILL_RATE = 1.0 / 60
+    SOFT_LIMIT = 75  # percent of the Graph API quota
+    BACKOFF_MIN = 60  # seconds
+    BACKOFF_MAX = 3600
+
+    def __init__(self):
+        self._tokens = self.CAPACITY
+        self._updated = time.time()
+        self._usage = 0
+        self._backoff = 0
+        self._blocked_until = 0
+
+    def _refill_rate(self):
+        if self._usage <= self.SOFT_LIMIT:
+            return self.REFILL_RATE
+
+        left = max(100 - self._usage, 0) / float(100 - self.SOFT_LIMIT)
+        return max(self.REFILL_RATE * left, self.MIN_REFILL_RATE)
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self.CAPACITY,
+                           self._tokens + elapsed * self._refill_rate())
+        self._updated = now
+
+    def delay(self, now):
+        """ seconds to wait before the next request can be made """
+        if now < self._blocked_until:
+            return self._blocked_until - now
+
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._refill_rate()
+
+    def consume(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+    def update_usage(self, usage, regain_seconds=0):
+        self._usage = usage
+        if regain_seconds > 0:
+            self._blocked_until = max(self._blocked_until,
+                                      time.time() + regain_seconds)
+
+    def throttled(self, regain_seconds=0):
+        self._backoff = min(max(self._backoff * 2, self.BACKOFF_MIN),
+                            self.BACKOFF_MAX)
+        self._tokens = 0
+        self._blocked_until = time.time() + max(self._backoff,
+                                                regain_seconds)
+
+    def succeeded(self):
+        self._backoff = 0
+
+
+class FbScheduler():
+    """ Rate limiting shared by every FbClient.
+
+    Queued requests are started as soon as the budget of the session
+    they belong to allows it, higher priority ones first and in order
+    otherwise. Requests for a session that is being throttled wait while
+    those of other sessions go ahead.
+    """
+    USAGE_HEADERS = ('x-app-usage', 'x-business-use-case-usage')
+    THROTTLE_ERROR_CODES = (4, 17, 32, 613)
+
+    @classmethod
+    def pick(cls, requests, now, lowest_priority=None):
+        """ returns the index of the request to start, or None and the
+        seconds to wait until one can be; requests of a priority below
+        lowest_priority are not considered """
+        index = None
+        wait = None
+        for i, request in enumerate(requests):
+            if lowest_priority is not None and \
+                    request.priority > lowest_priority:
+                continue
+
+            delay = request.session.budget.delay(now)
+            if delay <= 0:
+                if index is None or \
+                        request.priority < requests[index].priority:
+                    index = i
+            else:
+                wait = delay if wait is None else min(wait, delay)
+
+        if index is not None:
+            return index, 0
+        return None, wait
+
+    @classmethod
+    def report(cls, session, headers, response_str, http_code):
+        """ update the budget of a session after one of its requests """
+        budget = session.budget
+
+        usage, regain_seconds = cls._usage_from_headers(headers)
+        if usage is not None:
+            logging.debug("FbScheduler: usage at %d%%" % (usage))
+            budget.update_usage(usage, regain_seconds)
+
+        if http_code == 200:
+            budget.succeeded()
+        elif cls._is_throttle_error(response_str):
+            logging.debug("FbScheduler: throttled, backing off")
+            budget.throttled(regain_seconds)
+
+    @classmethod
+    def _usage_from_headers(cls, headers):
+        usage = None
+        regain_seconds = 0
+
+        for name in cls.USAGE_HEADERS:
+            if name not in headers:
+                continue
+
+            try:
+                value = json.loads(headers[name])
+                if name == 'x-app-usage':
+                    entries = [value]
+                else:
+                    entries = [e for l in value.values() for e in l]
+
+                header_usage = None
+                header_regain_seconds = 0
+                for entry in entries:
+                    for field in ('call_count', 'total_cputime',
+                                  'total_time'):
+                        header_usage = max(header_usage or 0,
+                                           int(entry.get(field, 0)))
+                    minutes = entry.get('estimated_time_to_regain_access', 0)
+                    header_regain_seconds = max(header_regain_seconds,
+                                                int(minutes) * 60)
+            except (ValueError, TypeError, AttributeError):
+                logging.debug("FbScheduler: bad %s header" % (name))
+                continue
+
+            if header_usage is not None:
+                usage = max(usage or 0, header_usage)
+            regain_seconds = max(regain_seconds, header_regain_seconds)
+
+        return usage, regain_seconds
+
+    @classmethod
+    def _is_throttle_error(cls, response_str):
+        try:
+            error = json.loads(response_str)['error']
+            return error.get('code') in cls.THROTTLE_ERROR_CODES
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+
+
+class FbBadCall(Exception):
+    pass
+
+FB_TRANSFER_DOWNLOAD = 0
+FB_TRANSFER_UPLOAD = 1
+
+FB_TRANSFER_CANCELLED = "Transfer cancelled"
+
+FB_PHOTO = 0
+FB_COMMENT = 1
+FB_LIKE = 2
+FB_STATUS = 3
+FB_TOKEN = 4
+
+FB_TYPES = {
+    FB_PHOTO: "photo",
+    FB_COMMENT: "comment",
+    FB_LIKE: "like",
+    FB_STATUS: "status",
+    FB_TOKEN: "token",
+}
+
+# interactive requests are started first and get the largest share of the
+# bandwidth, background ones the smallest
+FB_PRIORITY_INTERACTIVE = 0
+FB_PRIORITY_BULK = 1
+FB_PRIORITY_BACKGROUND = 2
+
+FB_PRIORITY_WEIGHTS = {
+    FB_PRIORITY_INTERACTIVE: 4,
+    FB_PRIORITY_BULK: 2,
+    FB_PRIORITY_BACKGROUND: 1,
+}
+
+
+def _id_from_response(response_str):
+    response_object = json.loads(response_str)
+
+    if not "id" in response_object:
+        raise FbBadCall(response_str)
+
+    fb_object_id = response_object['id'].encode('ascii', 'replace')
+    return fb_object_id
+
+
+def _token_from_response(response_str):
+    """ older Graph API versions answer form encoded instead of JSON """
+    try:
+        response_object = json.loads(response_str)
+    except ValueError:
+        response_object = dict(urlparse.parse_qsl(response_str))
+
+    if not isinstance(response_object, dict) or \
+            'access_token' not in response_object:
+        raise FbBadCall(response_str)
+
+    expires_in = response_object.get('expires_in',
+                                     response_object.get('expires', 0))
+    return response_object['access_token'], int(expires_in)
+
+
+def _comments_from_response(response_str):
+    logging.debug("_comments_from_response: %s" % (response_str))
+
+    response_data = json.loads(response_str)
+    if 'data' not in response_data:
+        raise FbBadCall("No data inside the FB response")
+
+    comments = []
+    for c in response_data['data']:
+        comment = {}  # this should be an Object
+        comment['from'] = c['from']['name']
+        comment['message'] = c['message']
+        comment['created_time'] = c['created_time']
+        comment['like_count'] = c['like_count']
+        comment['id'] = c['id']
+        comments.append(comment)
+
+    return comments
+
+
+class FbRequest(object):
+    """ A Graph API call queued in, or transferred by, an FbClient.
+
+    The request is made with the access token its session had when it
+    was submitted. Once the request is done callback(request) is called.
+    result is then the HTTP code, or the curl error code if the transfer
+    did not complete; value is what the response was parsed into and
+    error the reason of the failure, if any.
+    """
+
+    def __init__(self, client, session, fb_type, url, params, post, timeout,
+                 parse, callback, priority):
+        self.fb_type = fb_type
+        self.priority = priority
+        self.url = url
+        self.params = params
+        self.post = post
+        self.timeout = timeout
+        self.session = session
+        self.access_token = session.access_token()
+        self.progress_cb = None
+        self.cancelled = False
+
+        self.result = None
+        self.value = None
+        self.error = None
+        self.response = ""
+
+        self._client = client
+        self._parse = parse
+        self._callback = callback
+        self._handle = None
+        self._body = []
+        self._headers = {}
+
+    @property
+    def transfer_type(self):
+        if self.post:
+            return FB_TRANSFER_UPLOAD
+        return FB_TRANSFER_DOWNLOAD
+
+    def done(self):
+        return self.result is not None
+
+    def cancel(self):
+        """ drop the request, or abort its transfer if already started """
+        self._client._cancel(self)
+
+
+class FbClient(object):
+    """ Graph API client that needs no main loop of its own.
+
+    Transfers don't block: perform() starts the queued requests the
+    scheduler lets through, up to max_concurrent at once, and advances
+    the active ones. It is called either by run() or from the caller's
+    main loop; a main loop can also watch curl's sockets itself, see
+    set_event_callbacks(). Requests of different sessions run side by
+    side; those submitted without a session use the default one,
+    FbAccount's.
+
+    One slot above max_concurrent is kept for interactive requests, so
+    they don't wait for bulk uploads to finish, and the max_send_speed
+    and max_recv_speed caps (bytes per second, 0 for none) are shared
+    between the active transfers according to their priority.
+    """
+    PHOTOS_URL = "https://graph.facebook.com/me/photos"
+    COMMENTS_URL = "https://graph.facebook.com/%s/comments"
+
+    MAX_CONCURRENT = 4
+    INTERACTIVE_SLOTS = 1
+    POLL_INTERVAL = 0.1
+
+    # all in seconds, except LOW_SPEED_LIMIT which is in bytes per second
+    CONNECT_TIMEOUT = 30
+    CREATE_TIMEOUT = 600
+    COMMENT_TIMEOUT = 60
+    LOW_SPEED_LIMIT = 100
+    LOW_SPEED_TIME = 30
+
+    def __init__(self, max_concurrent=None, max_send_speed=0,
+                 max_recv_speed=0):
+        if max_concurrent is None:
+            max_concurrent = self.MAX_CONCURRENT
+        self.max_concurrent = max_concurrent
+        self.max_send_speed = max_send_speed
+        self.max_recv_speed = max_recv_speed
+
+        self._multi = pycurl.CurlMulti()
+        FbTransport.setup_multi(self._multi)
+        self._queue = []
+        self._active = []
+        # requests waiting for the token of their session to be checked
+        self._held = {}
+        self._performing = False
+
+    def create_photo(self, image_path, caption=None, callback=None,
+                     session=None, priority=FB_PRIORITY_BULK):
+        """ caption is sent along with the image, in the same request """
+        params = [('source', (pycurl.FORM_FILE, image_path))]
+        if caption:
+            params.append(('message', caption))
+
+        return self._submit(session, FB_PHOTO, self.PHOTOS_URL, params, True,
+                            self.CREATE_TIMEOUT, _id_from_response,
+                            callback, priority, preflight=True)
+
+    def add_comment(self, fb_object_id, comment, callback=None,
+                    session=None, priority=FB_PRIORITY_INTERACTIVE):
+        url = self.COMMENTS_URL % (fb_object_id)
+        return self._submit(session, FB_COMMENT, url, [('message', comment)],
+                            True, self.COMMENT_TIMEOUT, _id_from_response,
+                            callback, priority)
+
+    def fetch_comments(self, fb_object_id, callback=None, session=None,
+                       priority=FB_PRIORITY_INTERACTIVE):
+        url = self.COMMENTS_URL % (fb_object_id)
+        return self._submit(session, FB_COMMENT, url, [], False,
+                            self.COMMENT_TIMEOUT, _comments_from_response,
+                            callback, priority)
+
+    def set_speed_limits(self, max_send_speed, max_recv_speed):
+        self.max_send_speed = max_send_speed
+        self.max_recv_speed = max_recv_speed
+        self._balance()
+
+    def busy(self):
+        return len(self._queue) > 0 or len(self._active) > 0 or \
+            len(self._held) > 0
+
+    def perform(self):
+        """ returns the seconds after which perform should be called
+        again, or None once every request is done """
+        self._drive(self._multi.perform)
+        return self._next_timeout()
+
+    def set_event_callbacks(self, socket_cb, timer_cb):
+        """ Have the caller's main loop wait for curl's sockets, instead
+        of calling perform() every POLL_INTERVAL.
+
+        socket_cb(fd, what) is told what to watch fd for: pycurl.POLL_IN,
+        POLL_OUT or POLL_INOUT, or POLL_REMOVE to stop watching it.
+        timer_cb(timeout) is told when, in seconds, socket_action() is
+        next due, or None for no timeout. Activity on a watched fd is
+        reported with socket_action(fd, events).
+        """
+        def socket_function(what, fd, multi, socketp):
+            socket_cb(fd, what)
+
+        def timer_function(timeout_ms):
+            if timeout_ms < 0:
+                timer_cb(None)
+            else:
+                timer_cb(timeout_ms / 1000.0)
+
+        self._multi.setopt(pycurl.M_SOCKETFUNCTION, socket_function)
+        self._multi.setopt(pycurl.M_TIMERFUNCTION, timer_function)
+
+    def socket_action(self, fd=None, events=0):
+        """ advance the transfers after events (pycurl.CSELECT_IN,
+        CSELECT_OUT, CSELECT_ERR) on fd, or after the timeout when fd is
+        None; returns the seconds after which to call it again so the
+        queued requests get started, or None if curl will tell """
+        if fd is None:
+            fd = pycurl.SOCKET_TIMEOUT
+
+        self._drive(lambda: self._multi.socket_action(fd, events))
+        return self._queue_timeout()
+
+    def _drive(self, action):
+        self._start_queued()
+
+        finished = []
+        self._performing = True
+        try:
+            ret = pycurl.E_CALL_MULTI_PERFORM
+            while ret == pycurl.E_CALL_MULTI_PERFORM:
+                ret, num_handles = action()
+
+            num_queued = 1
+            while num_queued > 0:
+                num_queued, ok_list, err_list = self._multi.info_read()
+                for c in ok_list:
+                    finished.append((c.fb_request,
+                                     c.getinfo(c.HTTP_CODE), None))
+                for c, errno, errmsg in err_list:
+                    finished.append((c.fb_request, errno, errmsg))
+        finally:
+            self._performing = False
+
+        for request, result, error_reason in finished:
+            self._finish(request, result, error_reason)
+
+    def run(self):
+        """ block until every request is done """
+        timeout = self.perform()
+        while timeout is not None:
+            if len(self._active) > 0:
+                self._multi.select(timeout)
+            else:
+                time.sleep(timeout)
+            timeout = self.perform()
+
+    def _submit(self, session, fb_type, url, params, post, timeout, parse,
+                callback, priority, preflight=False):
+        if session is None:
+            session = FbAccount.session()
+
+        request = FbRequest(self, session, fb_type, url, params, post,
+                            timeout, parse, callback, priority)
+        if not preflight or not self._hold(request):
+            self._queue.append(request)
+        return request
+
+    def _hold(self, request):
+        """ hold request back if the token of its session needs checking
+        first, returns whether it was """
+        session = request.session
+        if session in self._held:
+            self._held[session].append(request)
+            return True
+
+        if session.token_manager.preflight(self, self._preflight_cb) is None:
+            return False
+
+        self._held[session] = [request]
+        return True
+
+    def _preflight_cb(self, preflight_request):
+        session = preflight_request.session
+        # only a token that was turned down fails the uploads; after
+        # throttling or a network error they are queued anyway, and wait
+        # for the budget of their session like any other request
+        token_refused = preflight_request.error is not None and \
+            FbTokenManager.is_auth_error(preflight_request.response)
+        for request in self._held.pop(session, []):
+            if not token_refused:
+                # the token may have been exchanged meanwhile
+                request.access_token = session.access_token()
+                self._queue.append(request)
+            else:
+                self._finish(request, preflight_request.result,
+                             preflight_request.error)
+
+    def _next_timeout(self):
+        if not self.busy():
+            return None
+
+        timeout = self.POLL_INTERVAL
+        if len(self._active) > 0:
+            curl_timeout = self._multi.timeout()
+            if curl_timeout >= 0:
+                timeout = min(timeout, curl_timeout / 1000.0)
+
+        queue_timeout = self._queue_timeout()
+        if queue_timeout is not None:
+            timeout = min(timeout, queue_timeout)
+
+        return timeout
+
+    def _queue_timeout(self):
+        """ seconds until a queued request can be started, or None if
+        none can until a transfer finishes """
+        lowest_priority = self._lowest_startable_priority()
+        if len(self._queue) == 0 or lowest_priority is None:
+            return None
+
+        index, wait = FbScheduler.pick(self._queue, time.time(),
+                                       lowest_priority)
+        return wait
+
+    def _lowest_startable_priority(self):
+        """ the lowest priority a request can have to be started now, or
+        None when every slot is taken """
+        if len(self._active) < self.max_concurrent:
+            return FB_PRIORITY_BACKGROUND
+        elif len(self._active) < self.max_concurrent + self.INTERACTIVE_SLOTS:
+            return FB_PRIORITY_INTERACTIVE
+        return None
+
+    def _start_queued(self):
+        now = time.time()
+        started = False
+        while len(self._queue) > 0:
+            lowest_priority = self._lowest_startable_priority()
+            if lowest_priority is None:
+                break
+
+            index, wait = FbScheduler.pick(self._queue, now, lowest_priority)
+            if index is None:
+                break
+
+            request = self._queue.pop(index)
+            request.session.budget.consume(now)
+            self._start(request)
+            started = True
+
+        if started:
+            self._balance()
+
+    def _balance(self):
+        """ share the speed caps between the active transfers """
+        for post, option, max_speed in \
+                ((True, pycurl.MAX_SEND_SPEED_LARGE, self.max_send_speed),
+                 (False, pycurl.MAX_RECV_SPEED_LARGE, self.max_recv_speed)):
+            requests = [r for r in self._active if r.post == post]
+            total_weight = sum([FB_PRIORITY_WEIGHTS[r.priority]
+                                for r in requests])
+            for request in requests:
+                c = request._handle
+                if max_speed > 0:
+                    weight = FB_PRIORITY_WEIGHTS[request.priority]
+                    # never below what the stall detection aborts at
+                    speed = max(max_speed * weight / total_weight,
+                                2 * self.LOW_SPEED_LIMIT)
+                    # the deadline stretches with the part of the cap the
+                    # transfer gets, instead of making a fair share of it
+                    # time out
+                    timeout = max(request.timeout,
+                                  request.timeout * max_speed / speed)
+                else:
+                    speed = 0
+                    timeout = request.timeout
+                c.setopt(option, speed)
+                c.setopt(c.TIMEOUT, timeout)
+
+    def _start(self, request):
+        logging.debug('_start')
+
+        app_auth_params = [('access_token', request.access_token)]
+
+        def header_cb(buf):
+            if ':' in buf:
+                name, value = buf.split(':', 1)
+                request._headers[name.strip().lower()] = value.strip()
+
+        def progress_cb(*args):
+            if request.cancelled:
+                # a non-zero return value makes libcurl abort the transfer
+                return 1
+
+            if request.progress_cb is not None:
+                try:
+                    request.progress_cb(request, *args)
+                except Exception as ex:
+                    logging.debug("oops %s" % (str(ex)))
+            return 0
+
+        c = pycurl.Curl()
+        c.fb_request = request
+        c.setopt(c.NOPROGRESS, 0)
+        c.setopt(c.PROGRESSFUNCTION, progress_cb)
+        c.setopt(c.WRITEFUNCTION, request._body.append)
+        c.setopt(c.HEADERFUNCTION, header_cb)
+        c.setopt(c.CONNECTTIMEOUT, self.CONNECT_TIMEOUT)
+        c.setopt(c.TIMEOUT, request.timeout)
+        c.setopt(c.LOW_SPEED_LIMIT, self.LOW_SPEED_LIMIT)
+        c.setopt(c.LOW_SPEED_TIME, self.LOW_SPEED_TIME)
+
+        url = request.url
+        if request.post:
+            c.setopt(c.POST, 1)
+            c.setopt(c.HTTPPOST, app_auth_params + request.params)
+        else:
+            c.setopt(c.HTTPGET, 1)
+            params_str = urllib.urlencode(app_auth_params + request.params)
+            url = "%s?%s" % (url, params_str)
+
+        logging.debug("_start: %s" % (url))
+
+        FbTransport.setup(c, request.session)
+        c.setopt(c.URL, url)
+
+        request._handle = c
+        self._active.append(request)
+        self._multi.add_handle(c)
+
+    def _cancel(self, request):
+        if request.done():
+            return
+
+        request.cancelled = True
+        held = self._held.get(request.session, [])
+        if request in held:
+            held.remove(request)
+            if len(held) == 0:
+                del self._held[request.session]
+            self._finish(request, pycurl.E_ABORTED_BY_CALLBACK, None)
+        elif request in self._queue:
+            self._queue.remove(request)
+            self._finish(request, pycurl.E_ABORTED_BY_CALLBACK, None)
+        elif not self._performing:
+            self._finish(request, pycurl.E_ABORTED_BY_CALLBACK, None)
+            # its slot is free now, and nothing else may come to use it
+            self._start_queued()
+        # else the progress callback aborts the transfer
+
+    def _finish(self, request, result, error_reason):
+        if request.done():
+            # e.g. cancelled by the callback of a request that finished
+            # in the same batch
+            return
+
+        c = request._handle
+        if c is not None:
+            if error_reason is None:
+                logging.debug("_finish: %d bytes down, %d bytes up, "
+                              "first byte after %.3fs, total %.3fs" %
+                              (c.getinfo(c.SIZE_DOWNLOAD),
+                               c.getinfo(c.SIZE_UPLOAD),
+                               c.getinfo(c.STARTTRANSFER_TIME),
+                               c.getinfo(c.TOTAL_TIME)))
+
+            self._multi.remove_handle(c)
+            c.fb_request = None
+            c.close()
+            request._handle = None
+            self._active.remove(request)
+            self._balance()
+
+        request.result = result
+        request.response = "".join(request._body)
+
+        if request.cancelled and result == pycurl.E_ABORTED_BY_CALLBACK:
+            error_reason = FB_TRANSFER_CANCELLED
+        elif error_reason is None:
+            FbScheduler.report(request.session, request._headers,
+                               request.response, result)
+            if result != 200:
+                error_reason = "HTTP Code %d" % (result)
+
+        if error_reason is not None:
+            logging.debug("_finish failed: %s" % (error_reason))
+            request.error = error_reason
+        else:
+            try:
+                request.value = request._parse(request.response)
+            except Exception as ex:
+                logging.debug("Couldn't parse FB response: %s" % str(ex))
+                request.error = str(ex)
+
+        if request._callback is not None:
+            request._callback(request)
+
+
+IMAGE_EXTENSIONS = ('.gif', '.jpeg', '.jpg', '.png')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Upload every image in a directory to Facebook.")
+    parser.add_argument('directory')
+    parser.add_argument('-t', '--access-token',
+                        default=os.environ.get('FB_ACCESS_TOKEN'),
+                        help="defaults to $FB_ACCESS_TOKEN")
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=FbClient.MAX_CONCURRENT,
+                        help="number of concurrent uploads")
+    parser.add_argument('--max-upload-speed', type=int, default=0,
+                        help="in bytes per second, shared by the uploads")
+    parser.add_argument('--caption-from-name', action='store_true',
+                        help="use the file name as the photo caption")
+    args = parser.parse_args(argv)
+
+    if not args.access_token:
+        parser.error("an access token is needed")
+    if args.jobs < 1:
+        parser.error("at least one job is needed")
+
+    session = FbSession(args.access_token)
+    client = FbClient(args.jobs, args.max_upload_speed)
+    failed = []
+
+    def photo_created_cb(request, path):
+        if request.error is None:
+            print "%s: photo %s" % (path, request.value)
+        else:
+            print "%s: failed, %s" % (path, request.error)
+            failed.append(path)
+
+    for name in sorted(os.listdir(args.directory)):
+        path = os.path.join(args.directory, name)
+        root, ext = os.path.splitext(name)
+        if not os.path.isfile(path) or ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+
+        caption = root if args.caption_from_name else None
+        client.create_photo(path, caption,
+                            lambda request, path=path:
+                            photo_created_cb(request, path),
+                            session)
+
+    client.run()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
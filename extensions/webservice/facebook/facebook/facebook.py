@@ -20,53 +20,36 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
-import json
 import logging
 import pycurl
 import time
-import urllib
 
 from gi.repository import GObject
 
-
-class FbAccount():
-    _access_token = ""
-
-    @classmethod
-    def set_access_token(cls, access_token):
-        cls._access_token = access_token
-
-    @classmethod
-    def access_token(cls):
-        return cls._access_token
+# FbAccount, FbSession, FbTokenManager, FbBadCall and the FB_ constants
+# are also used through this module by the account and the control panel
+# code
+from client import FbAccount, FbSession, FbTokenManager, FbBadCall
+from client import FbClient
+from client import FB_TRANSFER_DOWNLOAD, FB_TRANSFER_UPLOAD
+from client import FB_TRANSFER_CANCELLED
+from client import FB_PHOTO, FB_COMMENT, FB_LIKE, FB_STATUS, FB_TOKEN
+from client import FB_TYPES
+from client import FB_PRIORITY_INTERACTIVE, FB_PRIORITY_BULK
+from client import FB_PRIORITY_BACKGROUND
 
 
 class FbObjectNotCreatedException(Exception):
     pass
 
 
-class FbBadCall(Exception):
-    pass
-
-FB_TRANSFER_DOWNLOAD = 0
-FB_TRANSFER_UPLOAD = 1
-
-FB_PHOTO = 0
-FB_COMMENT = 1
-FB_LIKE = 2
-FB_STATUS = 3
-
-FB_TYPES = {
-    FB_PHOTO: "photo",
-    FB_COMMENT: "comment",
-    FB_LIKE: "like",
-    FB_STATUS: "status",
-}
-
-
 class FbPhoto(GObject.GObject):
-    PHOTOS_URL = "https://graph.facebook.com/me/photos?access_token=%s"
-    COMMENTS_URL = "https://graph.facebook.com/%s/comments"
+    """ GObject adapter over FbClient, driven by the GLib main loop,
+    which watches curl's sockets and timer.
+
+    The transfers are made for session, or for the default FbAccount
+    session when none is given.
+    """
 
     __gsignals__ = {
         'photo-created': (GObject.SignalFlags.RUN_FIRST, None, ([str])),
@@ -91,60 +74,169 @@ class FbPhoto(GObject.GObject):
                                    ([str])),
     }
 
-    def __init__(self, fb_object_id=None):
+    _client = None
+    _pump_source_id = None
+    _pump_deadline = 0
+    _timer_source_id = None
+    _watch_source_ids = {}
+
+    def __init__(self, fb_object_id=None, session=None):
         GObject.GObject.__init__(self)
         self.fb_object_id = fb_object_id
+        self.session = session
+        self._requests = []
+
+    @classmethod
+    def client(cls):
+        """ the FbClient shared by every FbPhoto """
+        if cls._client is None:
+            cls._client = FbClient()
+            cls._client.set_event_callbacks(cls._socket_cb, cls._timer_cb)
+        return cls._client
+
+    @classmethod
+    def pump(cls):
+        """ get the requests submitted straight to client() going """
+        cls._pump_later(0)
+
+    @classmethod
+    def _pump_later(cls, timeout):
+        deadline = time.time() + timeout
+        if cls._pump_source_id is not None:
+            if cls._pump_deadline <= deadline:
+                return
+            GObject.source_remove(cls._pump_source_id)
+
+        cls._pump_deadline = deadline
+        cls._pump_source_id = GObject.timeout_add(int(timeout * 1000),
+                                                  cls._pump)
+
+    @classmethod
+    def _pump(cls):
+        cls._pump_source_id = None
+        cls._socket_action(None, 0)
+        return False
+
+    @classmethod
+    def _socket_action(cls, fd, events):
+        timeout = cls.client().socket_action(fd, events)
+        if timeout is not None:
+            cls._pump_later(timeout)
+
+    @classmethod
+    def _socket_cb(cls, fd, what):
+        if fd in cls._watch_source_ids:
+            GObject.source_remove(cls._watch_source_ids.pop(fd))
+
+        if what == pycurl.POLL_REMOVE:
+            return
+
+        condition = GObject.IO_ERR | GObject.IO_HUP
+        if what in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            condition |= GObject.IO_IN
+        if what in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            condition |= GObject.IO_OUT
+        cls._watch_source_ids[fd] = GObject.io_add_watch(fd, condition,
+                                                         cls._io_cb)
+
+    @classmethod
+    def _io_cb(cls, fd, condition):
+        events = 0
+        if condition & GObject.IO_IN:
+            events |= pycurl.CSELECT_IN
+        if condition & GObject.IO_OUT:
+            events |= pycurl.CSELECT_OUT
+        if condition & (GObject.IO_ERR | GObject.IO_HUP):
+            events |= pycurl.CSELECT_ERR
+
+        cls._socket_action(fd, events)
+        # _socket_cb removes the watch once curl is done with fd
+        return fd in cls._watch_source_ids
+
+    @classmethod
+    def _timer_cb(cls, timeout):
+        if cls._timer_source_id is not None:
+            GObject.source_remove(cls._timer_source_id)
+            cls._timer_source_id = None
+
+        if timeout is not None:
+            cls._timer_source_id = GObject.timeout_add(int(timeout * 1000),
+                                                       cls._timeout_cb)
+
+    @classmethod
+    def _timeout_cb(cls):
+        cls._timer_source_id = None
+        cls._socket_action(None, 0)
+        return False
 
-    def create(self, image_path):
-        GObject.idle_add(self._create, image_path)
+    def create(self, image_path, caption=None, priority=FB_PRIORITY_BULK):
+        """ caption is sent along with the image, in the same request """
+        self._submit(self.client().create_photo(image_path, caption,
+                                                self._create_cb,
+                                                self.session, priority))
 
-    def add_comment(self, comment):
+    def add_comment(self, comment, priority=FB_PRIORITY_INTERACTIVE):
         self.check_created('add_comment')
-        GObject.idle_add(self._add_comment, comment)
+        self._submit(self.client().add_comment(self.fb_object_id, comment,
+                                               self._add_comment_cb,
+                                               self.session, priority))
 
-    def refresh_comments(self):
+    def refresh_comments(self, priority=FB_PRIORITY_INTERACTIVE):
         """ raise an exception if no one is listening """
         self.check_created('refresh_comments')
-        GObject.idle_add(self._refresh_comments)
+        self._submit(self.client().fetch_comments(self.fb_object_id,
+                                                  self._refresh_comments_cb,
+                                                  self.session, priority))
+
+    def cancel(self):
+        """ drop the queued operations and abort the running transfers """
+        for request in self._requests[:]:
+            request.cancel()
+        # queued requests may be able to start in the freed slots
+        self._pump_later(0)
 
     def check_created(self, method_name):
         if self.fb_object_id is None:
             errmsg = "Need to call create before calling %s" % (method_name)
             raise FbObjectNotCreatedException(errmsg)
 
-    def _add_comment(self, comment):
-        url = self.COMMENTS_URL % (self.fb_object_id)
+    def _submit(self, request):
+        request.progress_cb = self._request_progress_cb
+        self._requests.append(request)
+        self._pump_later(0)
 
-        response = []
+    def _request_done(self, request):
+        self._requests.remove(request)
 
-        def write_cb(buf):
-            response.append(buf)
+        if request.result != 200:
+            if request.transfer_type == FB_TRANSFER_UPLOAD:
+                transfer_str = "Upload"
+            else:
+                transfer_str = "Download"
+            self.emit('transfer-failed', request.fb_type,
+                      request.transfer_type, request.error)
+            self.emit('transfer-state-changed', "%s failed: %s" %
+                      (transfer_str, request.error))
 
-        res = self._http_call(url, [('message', comment)], write_cb, True,
-                              FB_COMMENT)
+    def _add_comment_cb(self, request):
+        self._request_done(request)
+
+        res = request.result
         if res == 200:
-            try:
-                comment_id = self._id_from_response("".join(response))
-                self.emit('comment-added', comment_id)
-            except FbBadCall as ex:
-                self.emit('comment-add-failed', str(ex))
+            if request.error is None:
+                self.emit('comment-added', request.value)
+            else:
+                self.emit('comment-add-failed', request.error)
         else:
             logging.debug("_add_comment failed, HTTP resp code: %d" % (res))
             self.emit('comment-add-failed', "Add comment failed: %d" % (res))
 
-    def _create(self, image_path):
-        url = self.PHOTOS_URL % (FbAccount.access_token())
-        c = pycurl.Curl()
-        params = [('source', (c.FORM_FILE, image_path))]
+    def _create_cb(self, request):
+        self._request_done(request)
 
-        response = []
-
-        def write_cb(buf):
-            response.append(buf)
-
-        result = self._http_call(url, params, write_cb, True, FB_PHOTO)
-        if result == 200:
-            photo_id = self._id_from_response("".join(response))
+        result = request.result
+        if result == 200 and request.error is None:
+            photo_id = request.value
             self.fb_object_id = photo_id
             self.emit('photo-created', photo_id)
         else:
@@ -152,36 +244,23 @@ class FbPhoto(GObject.GObject):
 
             if result == 400:
                 failed_reason = "Expired access token."
+            elif result == pycurl.E_ABORTED_BY_CALLBACK:
+                failed_reason = FB_TRANSFER_CANCELLED
             elif result == 6:
                 failed_reason = "Network is down."
                 failed_reason += \
                     "Please connect to the network and try again."
+            elif result == 200:
+                failed_reason = request.error
             else:
                 failed_reason = "Failed reason unknown: %s" % (str(result))
 
             self.emit('photo-create-failed', failed_reason)
 
-    def _id_from_response(self, response_str):
-        response_object = json.loads(response_str)
-
-        if not "id" in response_object:
-            raise FbBadCall(response_str)
-
-        fb_object_id = response_object['id'].encode('ascii', 'replace')
-        return fb_object_id
-
-    def _refresh_comments(self):
-        """ this blocks """
-        url = self.COMMENTS_URL % (self.fb_object_id)
+    def _refresh_comments_cb(self, request):
+        self._request_done(request)
 
-        logging.debug("_refresh_comments fetching %s" % (url))
-
-        response_comments = []
-
-        def write_cb(buf):
-            response_comments.append(buf)
-
-        ret = self._http_call(url, [], write_cb, False, FB_COMMENT)
+        ret = request.result
         if ret != 200:
             logging.debug("_refresh_comments failed, HTTP resp code: %d" %
                           ret)
@@ -189,82 +268,21 @@ class FbPhoto(GObject.GObject):
                       "Comments download failed: %d" % (ret))
             return
 
-        logging.debug("_refresh_comments: %s" % ("".join(response_comments)))
-
-        try:
-            response_data = json.loads("".join(response_comments))
-            if 'data' not in response_data:
-                logging.debug("No data inside the FB response")
-                self.emit('comments-download-failed',
-                          "Comments download failed with no data")
-                return
-        except Exception as ex:
-            logging.debug("Couldn't parse FB response: %s" % str(ex))
+        if request.error is not None:
             self.emit('comments-download-failed',
-                      "Comments download failed: %s" % (str(ex)))
+                      "Comments download failed: %s" % (request.error))
             return
 
-        comments = []
-        for c in response_data['data']:
-            comment = {}  # this should be an Object
-            comment['from'] = c['from']['name']
-            comment['message'] = c['message']
-            comment['created_time'] = c['created_time']
-            comment['like_count'] = c['like_count']
-            comment['id'] = c['id']
-            comments.append(comment)
-
+        comments = request.value
         if len(comments) > 0:
             self.emit('comments-downloaded', comments)
         else:
             self.emit('comments-download-failed', 'No comments found')
 
-    def _http_call(self, url, params, write_cb, post, fb_type):
-        logging.debug('_http_call')
-
-        app_auth_params = [('access_token', FbAccount.access_token())]
-
-        def f(*args):
-            logging.debug('will call _http_progress_cb')
-            try:
-                args = list(args) + [fb_type]
-                logging.debug(args)
-                self._http_progress_cb(*args)
-            except Exception as ex:
-                logging.debug("oops %s" % (str(ex)))
-
-        c = pycurl.Curl()
-        c.setopt(c.NOPROGRESS, 0)
-        c.setopt(c.PROGRESSFUNCTION, f)
-        c.setopt(c.WRITEFUNCTION, write_cb)
-
-        if post:
-            c.setopt(c.POST, 1)
-            c.setopt(c.HTTPPOST, app_auth_params + params)
-            transfer_type = FB_TRANSFER_UPLOAD
-            transfer_str = "Upload"
-        else:
-            c.setopt(c.HTTPGET, 1)
-            params_str = urllib.urlencode(app_auth_params + params)
-            url = "%s?%s" % (url, params_str)
-            transfer_type = FB_TRANSFER_DOWNLOAD
-            transfer_str = "Download"
-
-        logging.debug("_http_call: %s" % (url))
-
-        c.setopt(c.URL, url)
-        c.perform()
-
-        result = c.getinfo(c.HTTP_CODE)
-        if result != 200:
-            error_reason = "HTTP Code %d" % (result)
-            self.emit('transfer-failed', fb_type, transfer_type, error_reason)
-            self.emit('transfer-state-changed', "%s failed: %s" %
-                      (transfer_str, error_reason))
-
-        c.close()
-
-        return result
+    def _request_progress_cb(self, request, download_total, download_done,
+                             upload_total, upload_done):
+        self._http_progress_cb(download_total, download_done, upload_total,
+                               upload_done, request.fb_type)
 
     def _http_progress_cb(self, download_total, download_done,
                           upload_total, upload_done, fb_type):
@@ -319,6 +337,16 @@ def test_create_photo(loop):
     photo.create(photo_path)
 
 
+def test_create_photo_with_caption(loop):
+    def photo_created_cb(photo, photo_id, loop):
+        print "Photo created with caption: %s" % (photo_id)
+        loop.quit()
+
+    photo = FbPhoto()
+    photo.connect('photo-created', photo_created_cb, loop)
+    photo.create(photo_path, "this is a test caption")
+
+
 def test_add_comment(loop):
     def photo_created_cb(photo, photo_id, loop):
         print "Photo created: %s" % (photo_id)
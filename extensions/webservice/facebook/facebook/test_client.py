@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Raul Gutierrez S. - rgs@itevenworks.net
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+""" Offline checks of client.py, run on a stub pycurl whose transfers
+only complete when a test says so:
+
+    python test_client.py
+"""
+
+import json
+import sys
+import time
+import types
+import unittest
+
+_OPTIONS = ['NOPROGRESS', 'PROGRESSFUNCTION', 'WRITEFUNCTION',
+            'HEADERFUNCTION', 'CONNECTTIMEOUT', 'TIMEOUT', 'LOW_SPEED_LIMIT',
+            'LOW_SPEED_TIME', 'POST', 'HTTPPOST', 'HTTPGET', 'URL',
+            'ENCODING', 'SHARE', 'HTTP_VERSION', 'HTTP_CODE', 'SIZE_DOWNLOAD',
+            'SIZE_UPLOAD', 'STARTTRANSFER_TIME', 'TOTAL_TIME',
+            'MAX_SEND_SPEED_LARGE', 'MAX_RECV_SPEED_LARGE']
+
+
+class _StubCurl(object):
+
+    def __init__(self):
+        self.options = {}
+        self.http_code = 0
+        self.closed = False
+
+    def setopt(self, option, value):
+        self.options[option] = value
+
+    def getinfo(self, info):
+        if info == 'HTTP_CODE':
+            return self.http_code
+        return 0
+
+    def close(self):
+        self.closed = True
+
+
+class _StubCurlMulti(object):
+
+    def __init__(self):
+        self.handles = []
+        self._done = []
+
+    def setopt(self, option, value):
+        pass
+
+    def add_handle(self, c):
+        self.handles.append(c)
+
+    def remove_handle(self, c):
+        self.handles.remove(c)
+
+    def perform(self):
+        for c in self.handles:
+            if c.options['PROGRESSFUNCTION'](0, 0, 0, 0):
+                self._done.append((c, 42, "Callback aborted"))
+        return 0, len(self.handles)
+
+    def socket_action(self, fd, events):
+        return self.perform()
+
+    def info_read(self):
+        ok_list = [c for c, errno, errmsg in self._done if errno == 0]
+        err_list = [d for d in self._done if d[1] != 0]
+        self._done = []
+        return 0, ok_list, err_list
+
+    def timeout(self):
+        return -1
+
+    def complete(self, c, http_code, body="", headers=()):
+        """ make the transfer of c end with http_code on next perform """
+        for header in headers:
+            c.options['HEADERFUNCTION'](header)
+        c.options['WRITEFUNCTION'](body)
+        c.http_code = http_code
+        self._done.append((c, 0, None))
+
+
+class _StubCurlShare(object):
+
+    def setopt(self, option, value):
+        pass
+
+
+def _stub_pycurl():
+    pycurl = types.ModuleType('pycurl')
+    for name in _OPTIONS:
+        setattr(_StubCurl, name, name)
+        setattr(pycurl, name, name)
+    pycurl.error = Exception
+    pycurl.Curl = _StubCurl
+    pycurl.CurlMulti = _StubCurlMulti
+    pycurl.CurlShare = _StubCurlShare
+    pycurl.E_CALL_MULTI_PERFORM = -1
+    pycurl.E_ABORTED_BY_CALLBACK = 42
+    pycurl.FORM_FILE = 'FORM_FILE'
+    pycurl.SOCKET_TIMEOUT = -1
+    pycurl.version_info = lambda: (0, '', 0, '', 0)
+    return pycurl
+
+sys.modules['pycurl'] = _stub_pycurl()
+
+import client
+from client import FbAccount, FbClient, FbScheduler, FbSession
+from client import FB_PRIORITY_INTERACTIVE, FB_PRIORITY_BULK
+from client import FB_PRIORITY_BACKGROUND, FB_TRANSFER_CANCELLED
+
+
+def _checked_session(access_token="token"):
+    """ a session whose token needs no pre-flight check """
+    session = FbSession(access_token)
+    session.token_manager._checked = time.time()
+    return session
+
+
+class _Request(object):
+
+    def __init__(self, session, priority):
+        self.session = session
+        self.priority = priority
+
+
+class UsageTest(unittest.TestCase):
+
+    def test_usage_headers(self):
+        headers = {
+            'x-app-usage': json.dumps({'call_count': 80, 'total_time': 10,
+                                       'total_cputime': 5}),
+            'x-business-use-case-usage': json.dumps(
+                {'1234': [{'type': 'pages', 'call_count': 20,
+                           'total_time': 90,
+                           'estimated_time_to_regain_access': 2}]}),
+        }
+        usage, regain_seconds = FbScheduler._usage_from_headers(headers)
+        self.assertEqual(usage, 90)
+        self.assertEqual(regain_seconds, 120)
+
+    def test_no_or_bad_usage_headers(self):
+        self.assertEqual(FbScheduler._usage_from_headers({}), (None, 0))
+        self.assertEqual(
+            FbScheduler._usage_from_headers({'x-app-usage': 'junk'}),
+            (None, 0))
+
+    def test_usage_headers_of_the_wrong_shape(self):
+        for headers in ({'x-app-usage': '5'},
+                        {'x-app-usage': '[]'},
+                        {'x-app-usage': '{"call_count": "junk"}'},
+                        {'x-business-use-case-usage': '[1, 2]'},
+                        {'x-business-use-case-usage': '{"1234": 5}'}):
+            self.assertEqual(FbScheduler._usage_from_headers(headers),
+                             (None, 0), headers)
+
+        headers = {'x-app-usage': '5',
+                   'x-business-use-case-usage': json.dumps(
+                       {'1234': [{'call_count': 20}]})}
+        self.assertEqual(FbScheduler._usage_from_headers(headers), (20, 0))
+
+    def test_refill_slows_down_past_soft_limit(self):
+        budget = client._FbBudget()
+        budget.update_usage(budget.SOFT_LIMIT)
+        self.assertEqual(budget._refill_rate(), budget.REFILL_RATE)
+
+        budget.update_usage(90)
+        self.assertTrue(budget._refill_rate() < budget.REFILL_RATE)
+
+        budget.update_usage(100)
+        self.assertEqual(budget._refill_rate(), budget.MIN_REFILL_RATE)
+
+    def test_budget_runs_out(self):
+        budget = client._FbBudget()
+        now = time.time()
+        for i in range(int(budget.CAPACITY)):
+            self.assertEqual(budget.delay(now), 0)
+            budget.consume(now)
+        self.assertTrue(budget.delay(now) > 0)
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def _report(self, session, code, http_code=400):
+        response = json.dumps({'error': {'code': code}})
+        FbScheduler.report(session, {}, response, http_code)
+
+    def test_throttle_codes_back_off(self):
+        for code in (4, 17, 32, 613):
+            session = FbSession()
+            self._report(session, code)
+            delay = session.budget.delay(time.time())
+            self.assertTrue(delay > client._FbBudget.BACKOFF_MIN - 1, code)
+
+    def test_other_errors_dont_back_off(self):
+        session = FbSession()
+        self._report(session, 190)
+        self.assertEqual(session.budget.delay(time.time()), 0)
+
+    def test_backoff_doubles_and_resets(self):
+        session = FbSession()
+        self._report(session, 4)
+        self._report(session, 4)
+        self.assertEqual(session.budget._backoff,
+                         2 * client._FbBudget.BACKOFF_MIN)
+
+        FbScheduler.report(session, {}, '{"id": "1"}', 200)
+        self.assertEqual(session.budget._backoff, 0)
+
+    def test_bad_usage_header_finishes_the_batch(self):
+        fb_client = FbClient(max_concurrent=2)
+        multi = fb_client._multi
+        session = _checked_session()
+        requests = [fb_client.fetch_comments(str(i), None, session)
+                    for i in range(2)]
+        fb_client.perform()
+
+        multi.complete(requests[0]._handle, 200, '{"data": []}',
+                       ['X-App-Usage: 5\r\n'])
+        multi.complete(requests[1]._handle, 200, '{"data": []}')
+        fb_client.perform()
+
+        self.assertEqual([r.result for r in requests], [200, 200])
+        self.assertFalse(fb_client.busy())
+
+
+class PickTest(unittest.TestCase):
+
+    def test_priority_order(self):
+        session = FbSession()
+        requests = [_Request(session, FB_PRIORITY_BACKGROUND),
+                    _Request(session, FB_PRIORITY_BULK),
+                    _Request(session, FB_PRIORITY_INTERACTIVE),
+                    _Request(session, FB_PRIORITY_INTERACTIVE)]
+        self.assertEqual(FbScheduler.pick(requests, time.time()), (2, 0))
+
+    def test_lowest_priority(self):
+        session = FbSession()
+        requests = [_Request(session, FB_PRIORITY_BULK)]
+        self.assertEqual(FbScheduler.pick(requests, time.time(),
+                                          FB_PRIORITY_INTERACTIVE),
+                         (None, None))
+
+    def test_throttled_session_waits(self):
+        throttled = FbSession()
+        throttled.budget.throttled()
+        other = FbSession()
+        requests = [_Request(throttled, FB_PRIORITY_INTERACTIVE),
+                    _Request(other, FB_PRIORITY_BULK)]
+        self.assertEqual(FbScheduler.pick(requests, time.time()), (1, 0))
+
+        index, wait = FbScheduler.pick(requests[:1], time.time())
+        self.assertEqual(index, None)
+        self.assertTrue(wait > 0)
+
+class SessionTest(unittest.TestCase):
+
+    def test_token_taken_on_submit(self):
+        fb_client = FbClient()
+        session = _checked_session("first")
+        queued = fb_client.fetch_comments('1', None, session)
+        session.set_access_token("second")
+        fb_client.perform()
+
+        self.assertEqual(queued.access_token, "first")
+        self.assertTrue("access_token=first" in
+                        queued._handle.options['URL'])
+
+    def test_sessions_side_by_side(self):
+        fb_client = FbClient()
+        sessions = [_checked_session("a"), _checked_session("b")]
+        requests = [fb_client.fetch_comments('1', None, session)
+                    for session in sessions]
+        fb_client.perform()
+
+        self.assertEqual(
+            [r._handle.options['SHARE'] for r in requests],
+            [session.share() for session in sessions])
+        self.assertNotEqual(sessions[0].share(), sessions[1].share())
+
+    def test_throttled_session_doesnt_hold_others(self):
+        fb_client = FbClient()
+        sessions = [_checked_session("a"), _checked_session("b")]
+        sessions[0].budget.throttled()
+        requests = [fb_client.fetch_comments('1', None, session)
+                    for session in sessions]
+        fb_client.perform()
+
+        self.assertEqual(fb_client._queue, requests[:1])
+        self.assertEqual(fb_client._active, requests[1:])
+
+    def test_default_session(self):
+        fb_client = FbClient()
+        request = fb_client.fetch_comments('1')
+        self.assertTrue(request.session is FbAccount.session())
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FbClient(max_concurrent=2)
+        self.multi = self.client._multi
+        self.done = []
+
+    def _done_cb(self, request):
+        self.done.append((request, request.result, request.error))
+
+    def _handle(self, request):
+        return request._handle
+
+    def test_interactive_slot(self):
+        session = _checked_session()
+        uploads = [self.client.create_photo('/tmp/%d.png' % i, None,
+                                            self._done_cb, session)
+                   for i in range(3)]
+        self.client.perform()
+        refresh = self.client.fetch_comments('1', self._done_cb, session)
+        self.client.perform()
+
+        self.assertTrue(uploads[0] in self.client._active)
+        self.assertTrue(uploads[1] in self.client._active)
+        self.assertTrue(refresh in self.client._active)
+        self.assertTrue(uploads[2] in self.client._queue)
+
+    def test_balance(self):
+        self.client.set_speed_limits(60000, 0)
+        session = _checked_session()
+        upload = self.client.create_photo('/tmp/a.png', None, None, session)
+        comment = self.client.add_comment('1', 'hi', None, session)
+        self.client.perform()
+
+        upload_options = self._handle(upload).options
+        comment_options = self._handle(comment).options
+        self.assertEqual(upload_options['MAX_SEND_SPEED_LARGE'], 20000)
+        self.assertEqual(comment_options['MAX_SEND_SPEED_LARGE'], 40000)
+        self.assertEqual(upload_options['TIMEOUT'],
+                         3 * FbClient.CREATE_TIMEOUT)
+        self.assertEqual(comment_options['TIMEOUT'],
+                         FbClient.COMMENT_TIMEOUT * 3 / 2)
+
+        self.client.set_speed_limits(10, 0)
+        self.assertEqual(upload_options['MAX_SEND_SPEED_LARGE'],
+                         2 * FbClient.LOW_SPEED_LIMIT)
+        self.assertEqual(upload_options['TIMEOUT'], FbClient.CREATE_TIMEOUT)
+
+        self.client.set_speed_limits(0, 0)
+        self.assertEqual(upload_options['MAX_SEND_SPEED_LARGE'], 0)
+        self.assertEqual(upload_options['TIMEOUT'], FbClient.CREATE_TIMEOUT)
+
+    def test_receive_cap_keeps_a_deadline(self):
+        self.client.set_speed_limits(0, 1000)
+        session = _checked_session()
+        refresh = self.client.fetch_comments('1', None, session)
+        self.client.perform()
+
+        options = self._handle(refresh).options
+        self.assertEqual(options['MAX_RECV_SPEED_LARGE'], 1000)
+        self.assertEqual(options['TIMEOUT'], FbClient.COMMENT_TIMEOUT)
+
+    def test_deadlines(self):
+        session = _checked_session()
+        upload = self.client.create_photo('/tmp/a.png', None, None, session)
+        refresh = self.client.fetch_comments('1', None, session)
+        self.client.perform()
+
+        upload_options = self._handle(upload).options
+        self.assertEqual(upload_options['TIMEOUT'], FbClient.CREATE_TIMEOUT)
+        self.assertEqual(upload_options['CONNECTTIMEOUT'],
+                         FbClient.CONNECT_TIMEOUT)
+        self.assertEqual(upload_options['LOW_SPEED_LIMIT'],
+                         FbClient.LOW_SPEED_LIMIT)
+        self.assertEqual(upload_options['LOW_SPEED_TIME'],
+                         FbClient.LOW_SPEED_TIME)
+        self.assertEqual(self._handle(refresh).options['TIMEOUT'],
+                         FbClient.COMMENT_TIMEOUT)
+
+    def test_cancel_queued(self):
+        self.client = FbClient(max_concurrent=1)
+        session = _checked_session()
+        self.client.create_photo('/tmp/a.png', None, None, session)
+        queued = self.client.create_photo('/tmp/b.png', None, self._done_cb,
+                                          session)
+        self.client.perform()
+
+        queued.cancel()
+        self.assertEqual(self.done, [(queued, 42, FB_TRANSFER_CANCELLED)])
+        self.assertFalse(queued in self.client._queue)
+
+    def test_cancel_running(self):
+        session = _checked_session()
+        upload = self.client.create_photo('/tmp/a.png', None, self._done_cb,
+                                          session)
+        self.client.perform()
+        c = self._handle(upload)
+
+        upload.cancel()
+        self.assertEqual(self.done, [(upload, 42, FB_TRANSFER_CANCELLED)])
+        self.assertTrue(c.closed)
+        self.assertEqual(self.multi.handles, [])
+
+    def test_cancel_running_starts_queued(self):
+        self.client = FbClient(max_concurrent=1)
+        self.multi = self.client._multi
+        session = _checked_session()
+        running = self.client.create_photo('/tmp/a.png', None, None, session)
+        queued = self.client.create_photo('/tmp/b.png', None, None, session)
+        self.client.perform()
+
+        running.cancel()
+        self.assertTrue(queued in self.client._active)
+        self.assertEqual(self.multi.handles, [self._handle(queued)])
+
+    def test_cancel_running_from_progress(self):
+        session = _checked_session()
+        upload = self.client.create_photo('/tmp/a.png', None, self._done_cb,
+                                          session)
+        upload.progress_cb = lambda request, *args: request.cancel()
+        self.client.perform()
+        self.client.perform()
+
+        self.assertEqual(self.done, [(upload, 42, FB_TRANSFER_CANCELLED)])
+    def test_full_slots_dont_spin(self):
+        session = _checked_session()
+        for i in range(3):
+            self.client.create_photo('/tmp/%d.png' % i, None, None, session)
+        self.client.perform()
+        self.assertEqual(self.client._queue_timeout(), None)
+        self.assertTrue(self.client._next_timeout() > 0)
+
+    def test_done_when_idle(self):
+        session = _checked_session()
+        refresh = self.client.fetch_comments('1', self._done_cb, session)
+        self.assertTrue(self.client.busy())
+        self.client.perform()
+
+        comment = {'id': '1', 'from': {'name': 'A'}, 'message': 'hi',
+                   'created_time': '', 'like_count': 0}
+        self.multi.complete(self._handle(refresh), 200,
+                            json.dumps({'data': [comment]}))
+        self.assertEqual(self.client.perform(), None)
+        self.assertEqual(self.done, [(refresh, 200, None)])
+        self.assertEqual(refresh.value[0]['message'], "hi")
+
+    def test_cancel_from_a_callback_in_the_same_batch(self):
+        session = _checked_session()
+        first = self.client.fetch_comments('1', None, session)
+        second = self.client.fetch_comments('2', self._done_cb, session)
+        first._callback = lambda request: second.cancel()
+        self.client.perform()
+
+        self.multi.complete(self._handle(first), 200, '{"data": []}')
+        self.multi.complete(self._handle(second), 200, '{"data": []}')
+        self.client.perform()
+
+        self.assertEqual(self.done, [(second, 42, FB_TRANSFER_CANCELLED)])
+    def test_held_uploads_fail_with_the_preflight(self):
+        session = FbSession("stale")
+        uploads = [self.client.create_photo('/tmp/%d.png' % i, None,
+                                            self._done_cb, session)
+                   for i in range(2)]
+        self.client.perform()
+
+        self.assertEqual(len(self.multi.handles), 1)
+        check = self.multi.handles[0]
+        self.assertEqual(check.fb_request.fb_type, client.FB_TOKEN)
+
+        self.multi.complete(check, 400, '{"error": {"code": 190}}')
+        self.client.perform()
+
+        self.assertEqual([d[0] for d in self.done], uploads)
+        self.assertEqual([d[1] for d in self.done], [400, 400])
+        self.assertEqual(self.multi.handles, [])
+        self.assertFalse(self.client.busy())
+
+    def test_held_uploads_wait_after_a_throttled_preflight(self):
+        session = FbSession("busy")
+        uploads = [self.client.create_photo('/tmp/%d.png' % i, None,
+                                            self._done_cb, session)
+                   for i in range(2)]
+        self.client.perform()
+
+        check = self.multi.handles[0]
+        self.multi.complete(check, 403, '{"error": {"code": 4, '
+                            '"type": "OAuthException"}}')
+        self.client.perform()
+
+        self.assertEqual(self.done, [])
+        self.assertEqual(self.client._queue, uploads)
+        self.assertTrue(session.budget.delay(time.time()) > 0)
+
+    def test_held_uploads_queued_after_a_network_error(self):
+        session = FbSession("offline")
+        upload = self.client.create_photo('/tmp/a.png', None, self._done_cb,
+                                          session)
+        self.client.perform()
+
+        self.multi._done.append((self.multi.handles[0], 6, "no network"))
+        self.client.perform()
+        self.client.perform()
+
+        self.assertEqual(self.done, [])
+        self.assertTrue(upload in self.client._active)
+
+    def test_held_uploads_start_after_the_preflight(self):
+        session = FbSession("good")
+        upload = self.client.create_photo('/tmp/a.png', None, self._done_cb,
+                                          session)
+        self.client.perform()
+        self.multi.complete(self.multi.handles[0], 200, '{"id": "42"}')
+        self.client.perform()
+        self.client.perform()
+
+        self.assertTrue(upload in self.client._active)
+
+    def test_cancel_held(self):
+        session = FbSession("unchecked")
+        upload = self.client.create_photo('/tmp/a.png', None, self._done_cb,
+                                          session)
+        upload.cancel()
+
+        self.assertEqual(self.done, [(upload, 42, FB_TRANSFER_CANCELLED)])
+        self.assertFalse(session in self.client._held)
+
+
+class TokenTest(unittest.TestCase):
+
+    def test_token_from_response(self):
+        self.assertEqual(client._token_from_response(
+            '{"access_token": "long", "expires_in": 5184000}'),
+            ("long", 5184000))
+        self.assertEqual(client._token_from_response(
+            'access_token=long&expires=5184000'), ("long", 5184000))
+        self.assertRaises(client.FbBadCall, client._token_from_response,
+                          '{"error": {"code": 190}}')
+
+    def _exchange(self, body):
+        fb_client = FbClient()
+        session = FbSession("short")
+        token_manager = session.token_manager
+        token_manager.configure("app", exchange_url="http://localhost/")
+        token_manager.set_expiration_date(int(time.time()) + 3600)
+
+        self.assertTrue(token_manager.needs_refresh(time.time()))
+        request = token_manager.exchange(fb_client)
+        self.assertTrue(request.post)
+        fb_client.perform()
+        fb_client._multi.complete(request._handle, 200, body)
+        fb_client.perform()
+        return session
+
+    def test_exchange_without_expiry(self):
+        session = self._exchange('{"access_token": "long"}')
+        self.assertEqual(session.access_token(), "long")
+        self.assertEqual(session.token_manager.expiration_date, 0)
+        self.assertFalse(session.token_manager.needs_refresh(time.time()))
+
+    def test_exchange_without_later_expiry(self):
+        session = self._exchange(
+            '{"access_token": "long", "expires_in": 3600}')
+        self.assertFalse(session.token_manager.needs_refresh(time.time()))
+
+
+if __name__ == '__main__':
+    unittest.main()